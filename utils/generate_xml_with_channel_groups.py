@@ -1,14 +1,22 @@
-import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
+from lxml import etree as ET # libxml2 backed, same API as xml.etree for what we use here
+import numpy as np
+import copy
+import os
+
+# parsed template roots, keyed by (template path, modification time); each call works on a deep copy
+_TEMPLATE_CACHE = {}
 
 def prettify_xml(elem):
-    """Return a pretty-printed XML string for the Element."""
-    rough_string = ET.tostring(elem, encoding='utf-8')
-    reparsed = minidom.parseString(rough_string)
-    pretty = reparsed.toprettyxml(indent=" ", encoding='utf-8').decode('utf-8')
-    # Remove extra blank lines that minidom adds
-    lines = [line for line in pretty.split('\n') if line.strip()]
-    return '\n'.join(lines) + '\n'
+    """Return a pretty-printed XML string for the Element.
+
+    Not used when writing files anymore (generate_xml_with_channel_groups writes the
+    tree directly), kept for callers that want the XML as a string.
+    """
+    # Indent a copy (elem itself is left untouched) and serialize once, no minidom round trip
+    # (lxml refuses an XML declaration with encoding="unicode", so encode and decode)
+    elem = copy.deepcopy(elem)
+    ET.indent(elem, space=" ", level=0)
+    return ET.tostring(elem, encoding="utf-8", xml_declaration=True).decode("utf-8") + "\n"
 
 def generate_xml_with_channel_groups(template_xml_path, output_xml_path, channel_groups,  
                                       date=None, group_regions=None, channel_positions=None):
@@ -36,9 +44,12 @@ def generate_xml_with_channel_groups(template_xml_path, output_xml_path, channel
                 f"number of detected channel groups ({len(channel_groups)})"
             )
     
-    # Parse the template XML
-    tree = ET.parse(template_xml_path)
-    root = tree.getroot()
+    # Parse the template XML (only once per template file, later calls copy the cached tree)
+    template_key = (str(template_xml_path), os.path.getmtime(template_xml_path))
+    if template_key not in _TEMPLATE_CACHE:
+        _TEMPLATE_CACHE[template_key] = ET.parse(str(template_xml_path)).getroot()
+    root = copy.deepcopy(_TEMPLATE_CACHE[template_key])
+    tree = ET.ElementTree(root)
     
     # Find the anatomicalDescription section
     anat_desc = root.find('anatomicalDescription')
@@ -50,20 +61,6 @@ def generate_xml_with_channel_groups(template_xml_path, output_xml_path, channel
     if channel_groups_elem is not None:
         anat_desc.remove(channel_groups_elem)
     
-    # Create new channelGroups element
-    channel_groups_elem = ET.SubElement(anat_desc, 'channelGroups')
-    
-    # Add each group
-    for group_channels in channel_groups:
-        group_elem = ET.SubElement(channel_groups_elem, 'group')
-        
-        for channel_idx in group_channels:
-            channel_elem = ET.SubElement(group_elem, 'channel')
-            channel_elem.set('skip', '0')
-            # get_channel_groups returns 0-indexed channel indices
-            # XML also uses 0-indexed channel numbers, so use directly
-            channel_elem.text = str(channel_idx)
-    
     # Set date if provided
     if date is not None:
         general_info = root.find('generalInfo')
@@ -77,9 +74,14 @@ def generate_xml_with_channel_groups(template_xml_path, output_xml_path, channel
         else:
             print("Warning: generalInfo section not found in template")
     
-    # Build brain regions from group_regions if provided
-    # Generate BOTH per-channel region array AND brainRegions structure
-    if group_regions is not None and len(group_regions) > 0:
+    # Prepare brain region bookkeeping from group_regions if provided, so it can be
+    # filled in the same pass that builds the channelGroups
+    # (skipped when every region name is empty, nothing would be assigned; the template's
+    # regions are still cleared further down)
+    regions_dict = None
+    region_array = None
+    all_regions_empty = group_regions is not None and len(group_regions) > 0 and not any(group_regions)
+    if group_regions is not None and any(group_regions):
         # Get total number of channels
         acq_system = root.find('acquisitionSystem')
         if acq_system is not None:
@@ -87,55 +89,80 @@ def generate_xml_with_channel_groups(template_xml_path, output_xml_path, channel
             if n_channels_elem is not None:
                 n_channels = int(n_channels_elem.text)
                 
-                # Create a dict mapping region names to {channels: [], electrodeGroups: []}
-                from collections import defaultdict
-                regions_dict = defaultdict(lambda: {'channels': [], 'electrodeGroups': []})
+                # Create a dict mapping region names to {channels: [arrays per group], electrodeGroups: []}
+                # (dict.fromkeys keeps the regions in order of first appearance)
+                regions_dict = {region_name: {'channels': [], 'electrodeGroups': []}
+                                for region_name in dict.fromkeys(group_regions) if region_name}
                 
                 # Create per-channel region array for sessionInfo.region
-                region_array = [''] * n_channels
-                
-                # Assign channels and electrode groups based on channel groups
-                for group_idx, region_name in enumerate(group_regions):
-                    if region_name:  # Skip empty region names
-                        regions_dict[region_name]['channels'].extend(channel_groups[group_idx])
-                        regions_dict[region_name]['electrodeGroups'].append(group_idx)
-                        
-                        # Also populate per-channel region array
-                        for ch in channel_groups[group_idx]:
-                            region_array[ch] = region_name
-                
-                # 1. Set per-channel region array (for sessionInfo.region - MATLAB code expects this)
-                region_elem = root.find('region')
-                if region_elem is not None:
-                    region_elem.text = ' '.join(region_array)
-                    print(f"Set per-channel region array ({n_channels} channels)")
-                
-                # 2. Set brainRegions structure (for NeuroScope2 - expects .channels and .electrodeGroups)
-                brain_regions_elem = root.find('brainRegions')
-                if brain_regions_elem is not None:
-                    # Clear existing regions
-                    brain_regions_elem.clear()
-                    
-                    # Create XML structure for each brain region
-                    for region_name, data in regions_dict.items():
-                        region_node = ET.SubElement(brain_regions_elem, region_name)
-                        
-                        # Add channels element
-                        channels_elem = ET.SubElement(region_node, 'channels')
-                        channels_elem.text = ' '.join(str(ch) for ch in sorted(data['channels']))
-                        
-                        # Add electrodeGroups element
-                        electrode_groups_elem = ET.SubElement(region_node, 'electrodeGroups')
-                        electrode_groups_elem.text = ' '.join(str(eg) for eg in sorted(data['electrodeGroups']))
-                        
-                        print(f"Brain region '{region_name}': {len(data['channels'])} channels, electrode groups {data['electrodeGroups']}")
-                else:
-                    print("Warning: brainRegions section not found in template")
+                region_array = np.full(n_channels, '', dtype=object)
             else:
                 print("Warning: nChannels not found in acquisitionSystem")
         else:
             print("Warning: acquisitionSystem section not found")
     
+    # Add each group, assigning channels and electrode groups to regions along the way
+    # groups are written as XML text and parsed once below, much cheaper than one SubElement per channel
+    group_xml = []
+    if group_regions is None or len(group_regions) == 0:
+        group_regions = [None] * len(channel_groups)
+    for group_idx, (group_channels, region_name) in enumerate(zip(channel_groups, group_regions)):
+        # get_channel_groups returns 0-indexed channel indices
+        # XML also uses 0-indexed channel numbers, so use directly
+        group_xml.append('<group>' + ''.join(f'<channel skip="0">{ch}</channel>' for ch in group_channels) + '</group>')
+        
+        if regions_dict is not None and region_name:  # Skip empty region names
+            group_chs = np.asarray(group_channels, dtype=np.intp)
+            region_data = regions_dict[region_name]
+            region_data['channels'].append(group_chs)
+            region_data['electrodeGroups'].append(group_idx)
+            
+            # Also populate per-channel region array (single fancy-indexed assignment)
+            region_array[group_chs] = region_name
+    
+    # Create new channelGroups element
+    channel_groups_elem = ET.fromstring('<channelGroups>' + ''.join(group_xml) + '</channelGroups>')
+    anat_desc.append(channel_groups_elem)
+    
+    # Generate BOTH per-channel region array AND brainRegions structure
+    if regions_dict is not None:
+        # 1. Set per-channel region array (for sessionInfo.region - MATLAB code expects this)
+        region_elem = root.find('region')
+        if region_elem is not None:
+            region_elem.text = ' '.join(region_array.tolist())
+            print(f"Set per-channel region array ({n_channels} channels)")
+        
+        # 2. Set brainRegions structure (for NeuroScope2 - expects .channels and .electrodeGroups)
+        brain_regions_elem = root.find('brainRegions')
+        if brain_regions_elem is not None:
+            # Clear existing regions
+            brain_regions_elem.clear()
+            
+            # Create XML structure for each brain region
+            for region_name, data in regions_dict.items():
+                region_node = ET.SubElement(brain_regions_elem, region_name)
+                
+                # Add channels element (channels are kept per group, merge and sort them once)
+                chs = np.sort(np.concatenate(data['channels']))
+                channels_elem = ET.SubElement(region_node, 'channels')
+                channels_elem.text = ' '.join(chs.astype(str))
+                
+                # Add electrodeGroups element (already in ascending order, appended by group_idx)
+                electrode_groups_elem = ET.SubElement(region_node, 'electrodeGroups')
+                electrode_groups_elem.text = ' '.join(map(str, data['electrodeGroups']))
+                
+                print(f"Brain region '{region_name}': {len(chs)} channels, electrode groups {data['electrodeGroups']}")
+        else:
+            print("Warning: brainRegions section not found in template")
+    elif all_regions_empty:
+        # no channel gets a region, but don't keep regions left over from the template
+        region_elem = root.find('region')
+        if region_elem is not None:
+            region_elem.text = ''
+        brain_regions_elem = root.find('brainRegions')
+        if brain_regions_elem is not None:
+            brain_regions_elem.clear()
+    
     # Add channel positions if provided
     if channel_positions is not None:
         # Remove existing channelPositions section if present
@@ -156,13 +183,13 @@ def generate_xml_with_channel_groups(template_xml_path, output_xml_path, channel
         
     
     # Write the new XML
-    # Using prettify for better formatting
-    pretty_xml = prettify_xml(root)
-    
-    # Write to file
-    with open(output_xml_path, 'w', encoding='utf-8') as f:
-        f.write(pretty_xml)
-    
+    # Indent in place for better formatting, then stream straight to file
+    # (no intermediate pretty-printed string held in memory)
+    ET.indent(root, space=" ")
+    with open(output_xml_path, 'wb') as f:
+        tree.write(f, encoding='utf-8', xml_declaration=True)
+        f.write(b'\n') # end the file with a newline, like the pretty-printed output always did
+
     print(f"\nGenerated XML file: {output_xml_path}")
     print(f"Total groups: {len(channel_groups)}")
     total_channels = sum(len(g) for g in channel_groups)